@@ -1,18 +1,42 @@
 import os
-import glob
+import sys
+import asyncio
 import time
-import uuid
+import itertools
+import shutil
 import json
-import hashlib
+import importlib.util
+import logging
 import threading
 import subprocess
-from typing import Optional, Dict, Any
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate
+from typing import Optional, Dict, Any, Tuple
+
+import orjson
+import xxhash
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 
+# Must be set before matplotlib is imported (in the render worker or the
+# subprocess fallback): skip GUI backend probing and keep the font cache
+# across worker restarts even when $HOME is ephemeral.
+os.environ.setdefault("MPLBACKEND", "Agg")
+os.environ.setdefault("MPLCONFIGDIR", "/tmp/mpl-cache")
+os.makedirs(os.environ["MPLCONFIGDIR"], exist_ok=True)
+
+# The generator (matplotlib, osmnx, geopandas) is only imported inside the
+# render worker, so the API process stays light. Without it on the path,
+# fall back to running it as a subprocess.
+RENDER_IN_PROCESS = importlib.util.find_spec("create_map_poster") is not None
+
+logger = logging.getLogger(__name__)
+
 POSTERS_DIR = "posters"
 CACHE_DIR = "cache"
 JOBS_DIR = "jobs"
@@ -23,42 +47,197 @@ os.makedirs(JOBS_DIR, exist_ok=True)
 
 # ---- Helpers ----
 
-def list_themes():
-    files = sorted(glob.glob("themes/*.json"))
-    return [os.path.splitext(os.path.basename(f))[0] for f in files]
+# Themes ship with the app, so scan them once
+def _scan_themes() -> frozenset:
+    with os.scandir("themes") as it:
+        return frozenset(e.name[:-5] for e in it if e.name.endswith(".json") and e.is_file())
+
+THEMES: frozenset = _scan_themes()
 
-def sha1(s: str) -> str:
-    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+def list_themes():
+    return sorted(THEMES)
 
 def cache_key(city: str, country: str, theme: str, distance: int) -> str:
-    payload = json.dumps(
-        {"city": city.strip(), "country": country.strip(), "theme": theme.strip(), "distance": int(distance)},
-        sort_keys=True
-    )
-    return sha1(payload)
+    # Inputs are our own validated fields, so a fast non-cryptographic hash is enough
+    h = xxhash.xxh3_128()
+    h.update(city.strip().encode("utf-8"))
+    h.update(b"\x00")
+    h.update(country.strip().encode("utf-8"))
+    h.update(b"\x00")
+    h.update(theme.strip().encode("utf-8"))
+    h.update(b"\x00")
+    h.update(int(distance).to_bytes(4, "little"))
+    return h.hexdigest()
 
 def cache_png_path(key: str) -> str:
     return os.path.join(CACHE_DIR, f"{key}.png")
 
-def job_path(job_id: str) -> str:
-    return os.path.join(JOBS_DIR, f"{job_id}.json")
+# Seeded from the clock (ms) so ids stay unique across restarts that reuse the pid
+_JOB_COUNTER = itertools.count(int(time.time() * 1000))
+_PID = os.getpid()
+
+def new_job_id() -> str:
+    return f"{_PID:x}-{next(_JOB_COUNTER):x}"
+
+def accepts_encoding(header: str, coding: str) -> bool:
+    # Accept-Encoding tokens look like "br;q=0.8"; q=0 means "not acceptable"
+    for token in header.split(","):
+        name, _, params = token.partition(";")
+        if name.strip().lower() != coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            k, _, v = param.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        return q > 0
+    return False
+
+def stat_or_none(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+# Recently downloaded poster files as (bytes, mtime), keyed by path, under
+# a total size budget. Cached files and their sidecars never change once
+# written, so entries only leave by LRU eviction (or when superseded).
+PNG_CACHE: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+PNG_CACHE_LIMIT = 64 << 20
+PNG_CACHE_LOCK = threading.Lock()
+_png_cache_bytes = 0
+
+def get_png_bytes(path: str) -> Tuple[bytes, float]:
+    """Return a cached poster file's bytes and mtime (for Last-Modified)."""
+    global _png_cache_bytes
+    with PNG_CACHE_LOCK:
+        entry = PNG_CACHE.get(path)
+        if entry is not None:
+            PNG_CACHE.move_to_end(path)
+            return entry
+
+    with open(path, "rb") as f:
+        entry = (f.read(), os.fstat(f.fileno()).st_mtime)
+
+    if len(entry[0]) > PNG_CACHE_LIMIT:
+        return entry
+
+    with PNG_CACHE_LOCK:
+        if path not in PNG_CACHE:
+            PNG_CACHE[path] = entry
+            _png_cache_bytes += len(entry[0])
+            while _png_cache_bytes > PNG_CACHE_LIMIT:
+                _, (old, _) = PNG_CACHE.popitem(last=False)
+                _png_cache_bytes -= len(old)
+    return entry
+
+def drop_png_bytes(path: str) -> None:
+    global _png_cache_bytes
+    with PNG_CACHE_LOCK:
+        entry = PNG_CACHE.pop(path, None)
+        if entry is not None:
+            _png_cache_bytes -= len(entry[0])
+
+# Job state lives in memory; every update is also appended to an event log
+# so it can be rebuilt after a restart. The log has a single writer (this
+# process): compaction renames a new file over it.
+JOBS: Dict[str, Dict[str, Any]] = {}
+JOBS_LOCK = threading.Lock()
+JOBS_LOG_PATH = os.path.join(JOBS_DIR, "events.ndjson")
+# Rewrite the log as a snapshot of the latest states after this many appends
+JOBS_LOG_COMPACT_EVERY = 1000
+# Finished jobs older than this are dropped when compacting
+JOBS_RETENTION = 7 * 24 * 3600
+
+def _open_jobs_log() -> int:
+    return os.open(JOBS_LOG_PATH, os.O_APPEND | os.O_CREAT | os.O_WRONLY, 0o644)
+
+def _load_jobs() -> None:
+    if not os.path.exists(JOBS_LOG_PATH):
+        return
+    with open(JOBS_LOG_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                # Torn write from a crash
+                continue
+            JOBS[data["job_id"]] = data
+
+    # The queue does not survive a restart, so unfinished jobs never will
+    for job_id, data in JOBS.items():
+        if data.get("status") in ("PENDING", "RUNNING"):
+            JOBS[job_id] = {**data, "status": "ERROR", "message": "Interrupted by restart"}
+
+_load_jobs()
+JOBS_LOG = _open_jobs_log()
+_jobs_log_appends = 0
+# Lines appended while a compaction snapshot is being written, or None
+_jobs_log_pending: Optional[list] = None
 
 def write_job(job_id: str, data: Dict[str, Any]) -> None:
-    with open(job_path(job_id), "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    global _jobs_log_appends
+    line = (json.dumps({**data, "job_id": job_id}) + "\n").encode("utf-8")
+    with JOBS_LOCK:
+        JOBS[job_id] = data
+        os.write(JOBS_LOG, line)
+        _jobs_log_appends += 1
+        if _jobs_log_pending is not None:
+            _jobs_log_pending.append(line)
+
+def compact_jobs_log_if_due() -> None:
+    """
+    Rewrite the event log as a snapshot of the latest job states. Only
+    called from the job worker thread: the snapshot write and fsync run
+    without JOBS_LOCK, so handlers on the event loop never wait on them.
+    """
+    global JOBS_LOG, _jobs_log_appends, _jobs_log_pending
+    cutoff = time.time() - JOBS_RETENTION
+    with JOBS_LOCK:
+        if _jobs_log_appends < JOBS_LOG_COMPACT_EVERY:
+            return
+        for job_id in [
+            j for j, d in JOBS.items()
+            if d.get("status") in ("DONE", "ERROR") and d.get("created_at", 0) < cutoff
+        ]:
+            del JOBS[job_id]
+        snapshot = list(JOBS.values())
+        _jobs_log_pending = []
+
+    tmp = JOBS_LOG_PATH + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            for data in snapshot:
+                f.write((json.dumps(data) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+        with JOBS_LOCK:
+            # Carry over events written since the snapshot was taken
+            with open(tmp, "ab") as f:
+                f.writelines(_jobs_log_pending)
+            os.rename(tmp, JOBS_LOG_PATH)
+            os.close(JOBS_LOG)
+            JOBS_LOG = _open_jobs_log()
+            _jobs_log_appends = 0
+    except OSError:
+        # The existing log is still complete; try again on a later job
+        logger.exception("Job log compaction failed")
+    finally:
+        with JOBS_LOCK:
+            _jobs_log_pending = None
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
 def read_job(job_id: str) -> Dict[str, Any]:
-    p = job_path(job_id)
-    if not os.path.exists(p):
+    with JOBS_LOCK:
+        data = JOBS.get(job_id)
+    if data is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    with open(p, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def newest_png_in_posters() -> Optional[str]:
-    files = glob.glob(os.path.join(POSTERS_DIR, "*.png"))
-    if not files:
-        return None
-    return max(files, key=os.path.getmtime)
+    return data
 
 # ---- API ----
 
@@ -80,23 +259,186 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def warmup():
+    if RENDER_IN_PROCESS:
+        # Any call starts the render worker (and its initializer) now,
+        # so the first job does not pay for it
+        RENDER_POOL.submit(os.getpid)
+
 @app.get("/")
-def root():
+async def root():
     return {"status": "ok", "message": "Use /health, /generate_async, /job/{id}, /download/{id}"}
 
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True, "themes": list_themes()}
 
-# In-memory lock to avoid spawning too many threads at once on free tier
-JOB_LOCK = threading.Semaphore(1)
+# Jobs are rendered one at a time by a single consumer; the bound gives
+# backpressure instead of piling up work on the free tier
+JOB_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=32)
+
+# cache_key -> job_id of the queued/running job, so duplicates share it
+INFLIGHT: Dict[str, str] = {}
+INFLIGHT_LOCK = threading.Lock()
+
+RENDER_TIMEOUT = 240
+
+# Parsed themes, filled in inside the render worker process
+THEME_DATA: Dict[str, Dict[str, Any]] = {}
+
+def _preload_themes() -> None:
+    for name in THEMES:
+        with open(os.path.join("themes", f"{name}.json"), "rb") as f:
+            THEME_DATA[name] = orjson.loads(f.read())
+
+def _worker_init() -> None:
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    from matplotlib import font_manager
+    font_manager.fontManager  # builds or loads the font cache once
+    import osmnx, numpy  # noqa: F401
+    import create_map_poster
+    create_map_poster.warmup()
+    _preload_themes()
+
+def _render_in_worker(city: str, country: str, theme: str, distance: int, out_path: str) -> None:
+    import create_map_poster
+    create_map_poster.render(city, country, theme, distance, out_path, theme_data=THEME_DATA.get(theme))
+
+def _new_render_pool() -> ProcessPoolExecutor:
+    # One long-lived worker keeps matplotlib/osmnx warm; a crash there
+    # only takes down the worker, not the API
+    return ProcessPoolExecutor(max_workers=1, initializer=_worker_init)
+
+RENDER_POOL = _new_render_pool()
+
+def _replace_render_pool(kill: bool) -> None:
+    # A timed-out render keeps running in the only worker and would block
+    # every later job, so kill it rather than waiting
+    global RENDER_POOL
+    old = RENDER_POOL
+    if kill:
+        for proc in list(old._processes.values()):
+            proc.terminate()
+    old.shutdown(wait=False, cancel_futures=True)
+    RENDER_POOL = _new_render_pool()
+
+class GenerationError(Exception):
+    """Raised when the poster generator fails."""
+    pass
+
+def _generate_subprocess(req: GenerateRequest, distance: int, out_path: str) -> None:
+    # Same interpreter as the API; -I ignores PYTHON* env vars and user site,
+    # -B skips .pyc writes. Not -S: that would drop site-packages.
+    cmd = [
+        sys.executable, "-I", "-B",
+        "create_map_poster.py",
+        "--city", req.city.strip(),
+        "--country", req.country.strip(),
+        "--theme", req.theme.strip(),
+        "--distance", str(distance),
+        "--out", out_path,
+    ]
+
+    # Only the tail of stderr is kept for the error message
+    p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    tail: deque = deque(maxlen=40)
+
+    def _read_stderr() -> None:
+        # The reader owns the pipe: a grandchild may keep it open past our wait
+        with p.stderr:
+            tail.extend(p.stderr)
+
+    reader = threading.Thread(target=_read_stderr, daemon=True)
+    reader.start()
+    try:
+        rc = p.wait(timeout=RENDER_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.wait()
+        raise
+    finally:
+        reader.join(timeout=1)
+
+    if rc != 0:
+        raise GenerationError("".join(tail).strip() or "Generation failed")
+
+    if not os.path.exists(out_path):
+        raise GenerationError("Poster not found after generation.")
+
+def _generate(req: GenerateRequest, distance: int, out_path: str) -> None:
+    if not RENDER_IN_PROCESS:
+        _generate_subprocess(req, distance, out_path)
+        return
+
+    future = RENDER_POOL.submit(
+        _render_in_worker,
+        req.city.strip(),
+        req.country.strip(),
+        req.theme.strip(),
+        distance,
+        out_path,
+    )
+    try:
+        future.result(timeout=RENDER_TIMEOUT)
+    except FuturesTimeout as e:
+        if not future.done():
+            _replace_render_pool(kill=True)
+            raise
+        # FuturesTimeout is TimeoutError: the render itself raised one
+        # (e.g. a socket timeout), which is an ordinary failure
+        raise GenerationError(str(e) or "Generation failed") from e
+    except BrokenProcessPool as e:
+        _replace_render_pool(kill=False)
+        raise GenerationError("Render worker crashed") from e
+    except Exception as e:
+        raise GenerationError(str(e) or "Generation failed") from e
 
-def _run_generate(job_id: str, req: GenerateRequest, key: str) -> None:
-    # Pastikan hanya 1 job berat jalan di free tier
-    acquired = JOB_LOCK.acquire(timeout=1)
-    if not acquired:
-        time.sleep(1)
+# Sidecars are written one at a time, at low priority, after the job is DONE
+OPTIMIZE_POOL = ThreadPoolExecutor(max_workers=1)
+OPTIMIZE_TIMEOUT = 120
+
+def _run_tool(cmd: list, tmp: str, dest: str) -> bool:
+    nice = ["nice", "-n", "19"] if shutil.which("nice") else []
+    try:
+        res = subprocess.run(nice + cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=OPTIMIZE_TIMEOUT)
+        if res.returncode == 0:
+            os.replace(tmp, dest)
+            return True
+        return False
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _optimize_png(path: str) -> None:
+    """
+    Write sidecars for a published poster: a losslessly recompressed
+    path + ".opt" and a brotli copy path + ".br". The poster itself is
+    never touched. Each step is skipped if its tool is not installed,
+    fails or times out.
+    """
+    try:
+        optimizer = shutil.which("oxipng") or shutil.which("ect")
+        if optimizer:
+            # ect only works in place and needs a .png name
+            tmp = os.path.splitext(path)[0] + ".opt.tmp.png"
+            shutil.copyfile(path, tmp)
+            level = ["-o", "2"] if optimizer.endswith("oxipng") else []
+            if _run_tool([optimizer, *level, tmp], tmp, path + ".opt"):
+                # Downloads switch to the sidecar; free the superseded bytes
+                drop_png_bytes(path)
+
+        brotli = shutil.which("brotli")
+        if brotli:
+            source = path + ".opt" if os.path.exists(path + ".opt") else path
+            tmp = path + ".br.tmp"
+            _run_tool([brotli, "-q", "5", "-f", "-o", tmp, source], tmp, path + ".br")
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning("PNG optimization failed for %s: %s", path, e)
 
+def _run_generate(job_id: str, req: GenerateRequest, key: str) -> None:
+    compact_jobs_log_if_due()
     try:
         write_job(job_id, {
             "job_id": job_id,
@@ -106,85 +448,16 @@ def _run_generate(job_id: str, req: GenerateRequest, key: str) -> None:
             "message": "Generating..."
         })
 
+        # generate_async only queues cache misses, so no need to stat again
         cached = cache_png_path(key)
-        if os.path.exists(cached):
-            write_job(job_id, {
-                "job_id": job_id,
-                "status": "DONE",
-                "created_at": time.time(),
-                "cache_key": key,
-                "result": "/download/" + job_id,
-                "message": "Served from cache"
-            })
-            return
-
-        before = newest_png_in_posters()
-
-        cmd = [
-            "python",
-            "create_map_poster.py",
-            "--city", req.city.strip(),
-            "--country", req.country.strip(),
-            "--theme", req.theme.strip(),
-            "--distance", str(int(req.distance)),
-        ]
-
-        # Coba generate utama
-        res = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=240
-        )
-
-        # Kalau gagal, coba fallback distance lebih kecil
-        if res.returncode != 0:
-            if int(req.distance) > 2000:
-                cmd_fallback = cmd.copy()
-                cmd_fallback[-1] = "2000"
-
-                res2 = subprocess.run(
-                    cmd_fallback,
-                    capture_output=True,
-                    text=True,
-                    timeout=240
-                )
-
-                if res2.returncode != 0:
-                    msg = (res2.stderr or res2.stdout or "Generation failed").strip()
-                    write_job(job_id, {
-                        "job_id": job_id,
-                        "status": "ERROR",
-                        "created_at": time.time(),
-                        "cache_key": key,
-                        "message": msg[:2000]
-                    })
-                    return
-            else:
-                msg = (res.stderr or res.stdout or "Generation failed").strip()
-                write_job(job_id, {
-                    "job_id": job_id,
-                    "status": "ERROR",
-                    "created_at": time.time(),
-                    "cache_key": key,
-                    "message": msg[:2000]
-                })
-                return
-
-        time.sleep(0.5)
-        after = newest_png_in_posters()
-
-        if not after or after == before:
-            write_job(job_id, {
-                "job_id": job_id,
-                "status": "ERROR",
-                "created_at": time.time(),
-                "cache_key": key,
-                "message": "Poster not found after generation."
-            })
-            return
-
-        os.replace(after, cached)
+        try:
+            # Coba generate utama
+            _generate(req, int(req.distance), cached)
+        except GenerationError:
+            # Kalau gagal, coba fallback distance lebih kecil
+            if int(req.distance) <= 2000:
+                raise
+            _generate(req, 2000, cached)
 
         write_job(job_id, {
             "job_id": job_id,
@@ -195,7 +468,20 @@ def _run_generate(job_id: str, req: GenerateRequest, key: str) -> None:
             "message": "Done"
         })
 
-    except subprocess.TimeoutExpired:
+        # Off the critical path; downloads pick the sidecars up once they exist
+        OPTIMIZE_POOL.submit(_optimize_png, cached)
+
+    except GenerationError as e:
+        write_job(job_id, {
+            "job_id": job_id,
+            "status": "ERROR",
+            "created_at": time.time(),
+            "cache_key": key,
+            # Keep the end: that is where the final exception line is
+            "message": str(e)[-2000:]
+        })
+
+    except (subprocess.TimeoutExpired, FuturesTimeout):
         write_job(job_id, {
             "job_id": job_id,
             "status": "ERROR",
@@ -214,24 +500,34 @@ def _run_generate(job_id: str, req: GenerateRequest, key: str) -> None:
         })
 
     finally:
+        with INFLIGHT_LOCK:
+            INFLIGHT.pop(key, None)
+
+async def _worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        job_id, req, key = await JOB_QUEUE.get()
         try:
-            JOB_LOCK.release()
+            await loop.run_in_executor(None, _run_generate, job_id, req, key)
         except Exception:
-            pass
+            # Keep consuming; a dead worker would leave every job PENDING
+            logger.exception("Job %s failed outside its error handling", job_id)
+        finally:
+            JOB_QUEUE.task_done()
 
+@app.on_event("startup")
+async def start_worker():
+    # Keep a reference so the task is not garbage collected
+    app.state.worker = asyncio.create_task(_worker())
 
 @app.post("/generate_async")
-def generate_async(req: GenerateRequest):
-    themes = list_themes()
-    if req.theme not in themes:
-        raise HTTPException(status_code=400, detail=f"Theme invalid. Available: {themes}")
-
+async def generate_async(req: GenerateRequest):
     key = cache_key(req.city, req.country, req.theme, req.distance)
     cached = cache_png_path(key)
 
-    job_id = uuid.uuid4().hex[:10]
+    job_id = new_job_id()
 
-    # If cached, we can mark DONE immediately
+    # If cached, we can mark DONE immediately; a cached poster implies a valid theme
     if os.path.exists(cached):
         write_job(job_id, {
             "job_id": job_id,
@@ -243,7 +539,20 @@ def generate_async(req: GenerateRequest):
         })
         return {"job_id": job_id, "status": "DONE"}
 
-    # Otherwise create PENDING job and start thread
+    if req.theme not in THEMES:
+        raise HTTPException(status_code=400, detail=f"Theme invalid. Available: {list_themes()}")
+
+    # Otherwise queue it, unless the same poster is already on its way.
+    # The worker cannot pick it up before we record PENDING.
+    with INFLIGHT_LOCK:
+        if key in INFLIGHT:
+            return {"job_id": INFLIGHT[key], "status": "PENDING", "coalesced": True}
+        try:
+            JOB_QUEUE.put_nowait((job_id, req, key))
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Busy, try again later")
+        INFLIGHT[key] = job_id
+
     write_job(job_id, {
         "job_id": job_id,
         "status": "PENDING",
@@ -252,18 +561,15 @@ def generate_async(req: GenerateRequest):
         "message": "Queued"
     })
 
-    t = threading.Thread(target=_run_generate, args=(job_id, req, key), daemon=True)
-    t.start()
-
     return {"job_id": job_id, "status": "PENDING"}
 
 @app.get("/job/{job_id}")
-def job_status(job_id: str):
+async def job_status(job_id: str):
     data = read_job(job_id)
     return data
 
 @app.get("/download/{job_id}")
-def download(job_id: str):
+async def download(job_id: str, request: Request):
     data = read_job(job_id)
     if data.get("status") != "DONE":
         raise HTTPException(status_code=409, detail="Job not completed")
@@ -272,9 +578,40 @@ def download(job_id: str):
     if not key:
         raise HTTPException(status_code=500, detail="Missing cache key")
 
+    # Serve the best variant that exists: the brotli sidecar if the client
+    # accepts it, then the recompressed PNG, then the original
     path = cache_png_path(key)
-    if not os.path.exists(path):
+    variants = [("opt", path + ".opt")]
+    if accepts_encoding(request.headers.get("accept-encoding", ""), "br"):
+        variants.insert(0, ("br", path + ".br"))
+    variant, st = "", None
+    for name, candidate in variants:
+        st = stat_or_none(candidate)
+        if st is not None:
+            variant, path = name, candidate
+            break
+
+    # Every file is content-addressed by cache key and never changes once
+    # written, so each variant gets its own strong ETag
+    etag = f'"{key}-{variant}"' if variant else f'"{key}"'
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    if variant == "br":
+        headers["Content-Encoding"] = "br"
+        return FileResponse(path, media_type="image/png", filename=f"{job_id}.png", headers=headers, stat_result=st)
+
+    try:
+        data, mtime = await run_in_threadpool(get_png_bytes, path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Cached file not found")
 
     # nice filename
-    return FileResponse(path, media_type="image/png", filename=f"{job_id}.png")
+    headers["Content-Disposition"] = f'attachment; filename="{job_id}.png"'
+    headers["Last-Modified"] = formatdate(mtime, usegmt=True)
+    return Response(content=data, media_type="image/png", headers=headers)
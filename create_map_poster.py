@@ -616,6 +616,36 @@ def create_poster(city, country, point, dist, output_file, output_format, countr
     print(f"✓ Done! Poster saved as {output_file}")
 
 
+def render(city, country, theme, distance, out_path, output_format="png", country_label=None, theme_data=None):
+    """
+    Generate a single poster and write it to out_path.
+    Entry point for callers that import this module instead of running the CLI.
+    theme_data may hold the already-parsed theme to skip reading its file.
+    """
+    global THEME
+    THEME = theme_data if theme_data is not None else load_theme(theme)
+    coords = get_coordinates(city, country)
+
+    # Write to a sibling temp file so out_path only ever holds a complete poster
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    try:
+        create_poster(city, country, coords, distance, tmp_path, output_format, country_label=country_label)
+        os.replace(tmp_path, out_path)
+    finally:
+        # The API reuses one long-lived process; don't leak figures on failure
+        plt.close("all")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def warmup():
+    """
+    No-op hook for importers. Importing this module already loads
+    matplotlib, osmnx and the fonts, which is the expensive part.
+    """
+    return None
+
+
 def print_examples():
     """Print usage examples."""
     print("""
@@ -664,6 +694,7 @@ Options:
   --all-themes      Generate posters for all themes
   --distance, -d    Map radius in meters (default: 29000)
   --list-themes     List all available themes
+  --out, -o         Write the poster to this path instead of 'posters/'
 
 Distance guide:
   4000-6000m   Small/dense cities (Venice, Amsterdam old center)
@@ -720,6 +751,7 @@ Examples:
     parser.add_argument('--distance', '-d', type=int, default=29000, help='Map radius in meters (default: 29000)')
     parser.add_argument('--list-themes', action='store_true', help='List all available themes')
     parser.add_argument('--format', '-f', default='png', choices=['png', 'svg', 'pdf'],help='Output format for the poster (default: png)')
+    parser.add_argument('--out', '-o', type=str, help="Output file path (default: auto-named file in 'posters/')")
     
     args = parser.parse_args()
     
@@ -752,6 +784,10 @@ Examples:
             print(f"Available themes: {', '.join(available_themes)}")
             os.sys.exit(1)
         themes_to_generate = [args.theme]
+
+    if args.out and len(themes_to_generate) > 1:
+        print("Error: --out cannot be combined with --all-themes.")
+        os.sys.exit(1)
     
     print("=" * 50)
     print("City Map Poster Generator")
@@ -759,11 +795,9 @@ Examples:
     
     # Get coordinates and generate poster
     try:
-        coords = get_coordinates(args.city, args.country)
         for theme_name in themes_to_generate:
-            THEME = load_theme(theme_name)
-            output_file = generate_output_filename(args.city, theme_name, args.format)
-            create_poster(args.city, args.country, coords, args.distance, output_file, args.format, country_label=args.country_label)
+            output_file = args.out or generate_output_filename(args.city, theme_name, args.format)
+            render(args.city, args.country, theme_name, args.distance, output_file, args.format, country_label=args.country_label)
         
         print("\n" + "=" * 50)
         print("✓ Poster generation complete!")